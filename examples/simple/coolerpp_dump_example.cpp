@@ -6,8 +6,15 @@
 
 #include <algorithm>
 #include <cstdint>
+#include <cstdio>
 #include <exception>
+#include <iostream>
+#include <iterator>
+#include <memory>
+#include <string>
 #include <string_view>
+#include <type_traits>
+#include <vector>
 
 #include "coolerpp/coolerpp.hpp"
 
@@ -30,15 +37,85 @@ static void dump(const File& cooler) {
   print_pixels(cooler.begin<N>(), cooler.end<N>());
 }
 
+// Fixed-size record used to serialize pixels in binary mode.
+// Counts are always stored as doubles so that raw and balanced pixels share the same layout.
+struct PixelRecord {
+  std::uint64_t bin1_id;
+  std::uint64_t bin2_id;
+  double count;
+};
+static_assert(sizeof(PixelRecord) == 24);
+
+template <typename It>
+static void append_pixels(fmt::memory_buffer& buff, It first_pixel, It last_pixel) {
+  std::for_each(first_pixel, last_pixel, [&](const auto& pixel) {
+    fmt::format_to(std::back_inserter(buff), FMT_STRING("{:bg2}\n"), pixel);
+  });
+}
+
+template <typename It>
+static void append_pixels(std::vector<PixelRecord>& buff, It first_pixel, It last_pixel) {
+  std::transform(first_pixel, last_pixel, std::back_inserter(buff), [](const auto& pixel) {
+    return PixelRecord{pixel.coords.bin1.id(), pixel.coords.bin2.id(),
+                       static_cast<double>(pixel.count)};
+  });
+}
+
+// Text frames consist of a line with the size of the payload in bytes followed by pixels in bg2
+// format
+static void write_frame(const fmt::memory_buffer& buff) {
+  fmt::print(FMT_STRING("{}\n"), buff.size());
+  std::fwrite(buff.data(), sizeof(char), buff.size(), stdout);
+}
+
+// Binary frames consist of the number of records (as uint64) followed by the records themselves
+static void write_frame(const std::vector<PixelRecord>& buff) {
+  const std::uint64_t num_records = buff.size();
+  std::fwrite(&num_records, sizeof(num_records), 1, stdout);
+  std::fwrite(buff.data(), sizeof(PixelRecord), buff.size(), stdout);
+}
+
+// Read queries from stdin (one "range1\trange2" pair per line) and write each result to stdout as
+// a text or binary frame. This allows callers to run many queries without re-opening the Cooler
+// file every time.
+template <typename N, bool binary>
+static void dump_interactive(const File& cooler, std::string_view balance) {
+  const auto weights = balance.empty() || balance == "raw" ? std::shared_ptr<const Weights>(nullptr)
+                                                           : cooler.read_weights(balance);
+  std::conditional_t<binary, std::vector<PixelRecord>, fmt::memory_buffer> buff;
+  std::string line;
+  while (std::getline(std::cin, line)) {
+    const std::string_view query{line};
+    const auto pos = query.find('\t');
+    const auto range1 = query.substr(0, pos);
+    const auto range2 = pos == std::string_view::npos ? range1 : query.substr(pos + 1);
+
+    buff.clear();
+    auto selector = cooler.fetch<N>(range1, range2);
+    if (weights) {
+      const Balancer<N> balancer(selector, weights);
+      append_pixels(buff, balancer.begin(), balancer.end());
+    } else {
+      append_pixels(buff, selector.begin(), selector.end());
+    }
+
+    write_frame(buff);
+    std::fflush(stdout);
+  }
+}
+
 static void print_usage(std::string_view arg0) {
   fmt::print(stderr,
              FMT_STRING("Usage:   {0} my_cooler.cool [region1] [region2]\n"
+                        "         {0} my_cooler.cool --interactive [balance]\n"
+                        "         {0} my_cooler.cool --binary [balance]\n"
                         "Example: {0} my_cooler.cool\n"
                         "Example: {0} my_cooler.mcool::/resolutions/10000\n"
                         "Example: {0} my_cooler.cool chr1\n"
                         "Example: {0} my_cooler.cool chr1 chr2\n"
                         "Example: {0} my_cooler.cool chr1:50000-100000\n"
-                        "Example: {0} my_cooler.cool chr1:50000-100000 chr2\n"),
+                        "Example: {0} my_cooler.cool chr1:50000-100000 chr2\n"
+                        "Example: {0} my_cooler.cool --interactive weight\n"),
              arg0);
 }
 
@@ -61,7 +138,16 @@ int main(int argc, char** argv) {
     const auto cooler = File::open_read_only(path_to_cooler);
     const auto has_int_pixels = cooler.has_integral_pixels();
 
-    if (range1.empty() && range2.empty()) {
+    if (range1 == "--interactive" || range1 == "--binary") {
+      const std::string_view balance = argc < 4 ? "" : argv[3];  // NOLINT
+      if (range1 == "--binary") {
+        has_int_pixels ? dump_interactive<std::int64_t, true>(cooler, balance)
+                       : dump_interactive<double, true>(cooler, balance);
+      } else {
+        has_int_pixels ? dump_interactive<std::int64_t, false>(cooler, balance)
+                       : dump_interactive<double, false>(cooler, balance);
+      }
+    } else if (range1.empty() && range2.empty()) {
       has_int_pixels ? dump<std::int64_t>(cooler) : dump<double>(cooler);
     } else {
       has_int_pixels ? dump<std::int64_t>(cooler, range1, range2)
@@ -5,23 +5,40 @@
 # SPDX-License-Identifier: MIT
 
 import argparse
-import ctypes
-import itertools
+import collections
+import concurrent.futures
+import functools
 import logging
 import multiprocessing as mp
+import os
 import pathlib
-import random
-import shlex
 import shutil
+import struct
 import subprocess as sp
 import sys
 import time
-from typing import Dict, Tuple, Union
+from typing import Dict, List, Tuple, Union
 
 import cooler
+import h5py
 import numpy as np
 import pandas as pd
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    # Registers additional HDF5 filters (e.g. blosc and zstd).
+    # This makes it possible to run tests on files repacked with faster codecs.
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+# Used to skip calls to logging.debug() in hot loops. Updated by init_worker()
+debug_enabled = False
+
 
 def make_cli():
     def positive_int(arg):
@@ -30,15 +47,27 @@ def make_cli():
 
         raise ValueError("Not a positive integer")
 
+    def non_negative_int(arg):
+        if (n := int(arg)) >= 0:
+            return n
+
+        raise ValueError("Not a non-negative integer")
+
     def valid_fraction(arg):
         if (n := float(arg)) >= 0 and n <= 1:
             return n
 
         raise ValueError("Not a number between 0 and 1")
 
-    def valid_executable(arg):
+    @functools.lru_cache(maxsize=None)
+    def _which(arg: str) -> Union[pathlib.Path, None]:
         if (cmd := shutil.which(arg)) is not None:
             return pathlib.Path(cmd)
+        return None
+
+    def valid_executable(arg):
+        if (cmd := _which(arg)) is not None:
+            return cmd
 
         raise FileNotFoundError(f'Unable to find executable "{arg}"')
 
@@ -78,7 +107,7 @@ def make_cli():
     cli.add_argument(
         "--balance", type=str, help="Name of the dataset to use for balancing."
     )
-    cli.add_argument("--seed", type=int, default=2074288341)
+    cli.add_argument("--seed", type=non_negative_int, default=2074288341)
     cli.add_argument(
         "--nproc",
         type=int,
@@ -90,104 +119,216 @@ def make_cli():
 
 
 def cooler_dump(selector, query1: str, query2: str) -> pd.DataFrame:
-    logging.debug("[cooler] running query for %s, %s...", query1, query2)
+    if debug_enabled:
+        logging.debug("[cooler] running query for %s, %s...", query1, query2)
     df = selector.fetch(query1, query2)
     if "balanced" in df:
         df["count"] = df["balanced"]
-    return df.drop(columns="balanced", errors="ignore").set_index(
-        ["chrom1", "start1", "end1", "chrom2", "start2", "end2"]
-    )
+    return df.drop(columns="balanced", errors="ignore")
+
+
+class CoolerppDumpProc:
+    """
+    Wrapper around a coolerpp_dump process running in binary mode.
+    The process is spawned once and then used to run any number of queries.
+    """
+
+    # Must match the layout of PixelRecord from coolerpp_dump_example.cpp.
+    # Bin IDs are written as uint64, but they always fit in an int64 (which is
+    # what pandas expects when merging them with the bin IDs returned by cooler)
+    record_dtype = np.dtype([("bin1_id", "i8"), ("bin2_id", "i8"), ("count", "f8")])
+
+    def __init__(
+        self,
+        coolerpp_bin: pathlib.Path,
+        path_to_cooler_file: pathlib.Path,
+        balance: Union[bool, str],
+    ):
+        if not balance:
+            balance = "raw"
+        self._cmd = [
+            str(coolerpp_bin),
+            str(path_to_cooler_file),
+            "--binary",
+            balance,
+        ]
+
+        # Make the filters registered by hdf5plugin available to coolerpp_dump as well
+        env = None
+        if hdf5plugin is not None:
+            env = os.environ.copy()
+            env.setdefault("HDF5_PLUGIN_PATH", hdf5plugin.PLUGIN_PATH)
+
+        logging.debug("[coolerpp] Running %s...", self._cmd)
+        self._proc = sp.Popen(
+            self._cmd,
+            stdin=sp.PIPE,
+            stderr=sp.PIPE,
+            stdout=sp.PIPE,
+            bufsize=0,
+            env=env,
+        )
 
+        # Enlarge the pipe buffer (Linux only) so that large results can be transferred
+        # with fewer context switches
+        if hasattr(fcntl, "F_SETPIPE_SZ"):
+            try:
+                fcntl.fcntl(self._proc.stdout.fileno(), fcntl.F_SETPIPE_SZ, 1 << 20)
+            except OSError:
+                pass
+
+        # Buffer reused across queries to store the results read from the pipe
+        self._buff = bytearray()
+
+    def _raise_error(self):
+        _, err = self._proc.communicate()
+        if (code := self._proc.returncode) != 0:
+            print(err.decode(), file=sys.stderr)
+            raise RuntimeError(f"{self._cmd} terminated with code {code}")
+        raise RuntimeError(f"{self._cmd} terminated unexpectedly")
+
+    def _read_exactly(self, size: int) -> memoryview:
+        # The returned view is only valid until the next call to _read_exactly()
+        if len(self._buff) < size:
+            self._buff = bytearray(size)
+        view = memoryview(self._buff)[:size]
+        offset = 0
+        while offset < size:
+            if not (n := self._proc.stdout.readinto(view[offset:])):
+                self._raise_error()
+            offset += n
+        return view
+
+    def submit(self, queries: List[Tuple[str, str]]):
+        # Queries are processed in order: results should be read back with read_result()
+        if debug_enabled:
+            for query1, query2 in queries:
+                logging.debug("[coolerpp] running query for %s, %s...", query1, query2)
+        try:
+            self._proc.stdin.writelines(
+                f"{query1}\t{query2}\n".encode() for query1, query2 in queries
+            )
+            self._proc.stdin.flush()
+        except BrokenPipeError:
+            self._raise_error()
+
+    def read_result(self) -> pd.DataFrame:
+        (num_records,) = struct.unpack("=Q", self._read_exactly(8))
+        records = np.frombuffer(
+            self._read_exactly(num_records * self.record_dtype.itemsize),
+            dtype=self.record_dtype,
+        )
 
-def coolerpp_dump(
-    coolerpp_bin: pathlib.Path,
-    path_to_cooler_file: pathlib.Path,
-    balance: Union[bool, str],
-    query1: str,
-    query2: str,
-) -> pd.DataFrame:
-    if not balance:
-        balance = "raw"
-    cmd = [
-        shutil.which(str(coolerpp_bin)),
-        str(path_to_cooler_file),
-        balance,
-        query1,
-        query2,
-    ]
-
-    cmd = shlex.split(" ".join(str(tok) for tok in cmd))
-    logging.debug("[coolerpp] Running %s...", cmd)
-    sp.check_output(cmd, stderr=sp.STDOUT)
-
-    with sp.Popen(cmd, stdin=None, stderr=sp.PIPE, stdout=sp.PIPE) as coolerpp_dump:
-        df = pd.read_table(
-            coolerpp_dump.stdout,
-            names=["chrom1", "start1", "end1", "chrom2", "start2", "end2", "count"],
+        # Records point to the internal buffer, so they must be copied
+        return pd.DataFrame(
+            {
+                "bin1_id": records["bin1_id"],
+                "bin2_id": records["bin2_id"],
+                "count": records["count"],
+            },
+            copy=True,
         )
-        coolerpp_dump.communicate()
-        if (code := coolerpp_dump.returncode) != 0:
-            print(coolerpp_dump.stderr, file=sys.stderr)
-            raise RuntimeError(f"{cmd} terminated with code {code}")
 
-    return df.set_index(["chrom1", "start1", "end1", "chrom2", "start2", "end2"])
+    def close(self):
+        if self._proc.returncode is None:
+            self._proc.communicate()
 
 
 def read_chrom_sizes(path_to_cooler_file: pathlib.Path) -> Dict[str, int]:
     return cooler.Cooler(str(path_to_cooler_file)).chromsizes.to_dict()
 
 
-def generate_query_1d(
-    chroms, weights: np.ndarray, mean_length: float, stddev_length: float
-) -> str:
-    chrom_name, chrom_size = random.choices(chroms, weights=weights, k=1)[0]
+def generate_coords_batch(
+    rng: np.random.Generator,
+    chrom_sizes: np.ndarray,
+    cum_weights: np.ndarray,
+    mean_length: float,
+    stddev_length: float,
+    size: int,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    chrom_ids = np.searchsorted(
+        cum_weights, rng.random(size) * cum_weights[-1], side="right"
+    )
+    chrom_sizes = chrom_sizes[chrom_ids]
 
-    query_length = max(2.0, random.gauss(mu=mean_length, sigma=stddev_length))
+    query_lengths = np.maximum(2.0, rng.normal(mean_length, stddev_length, size))
 
-    center_pos = random.randint(0, chrom_size)
-    start_pos = max(0.0, center_pos - (query_length / 2))
-    end_pos = min(chrom_size, start_pos + query_length)
+    center_pos = rng.integers(0, chrom_sizes, endpoint=True)
+    start_pos = np.maximum(0.0, center_pos - (query_lengths / 2))
+    end_pos = np.minimum(chrom_sizes, start_pos + query_lengths)
 
-    return f"{chrom_name}:{start_pos:.0f}-{end_pos:.0f}"
+    return chrom_ids, np.rint(start_pos).astype(int), np.rint(end_pos).astype(int)
 
 
-def generate_query_2d(
-    chroms,
-    weights: np.ndarray,
-    ranks: Dict[str, int],
+def generate_query_batch(
+    rng: np.random.Generator,
+    chrom_sizes: np.ndarray,
+    cum_weights: np.ndarray,
+    ranks: np.ndarray,
     mean_length: float,
     stddev_length: float,
-) -> Tuple[str, str]:
-    q1 = generate_query_1d(chroms, weights, mean_length, stddev_length)
-    q2 = generate_query_1d(chroms, weights, mean_length, stddev_length)
-
-    chrom1, _, coord1 = q1.partition(":")
-    chrom2, _, coord2 = q2.partition(":")
+    _1d_to_2d_query_ratio: float,
+    size: int = 1024,
+) -> List[Tuple[int, int, int, int, int, int]]:
+    # Queries are returned as (chrom1_id, start1, end1, chrom2_id, start2, end2) tuples.
+    # Use format_query() to convert them to UCSC strings
+    chrom1, start1, end1 = generate_coords_batch(
+        rng, chrom_sizes, cum_weights, mean_length, stddev_length, size
+    )
+    chrom2, start2, end2 = generate_coords_batch(
+        rng, chrom_sizes, cum_weights, mean_length, stddev_length, size
+    )
 
-    if ranks[chrom1] > ranks[chrom2]:
-        q1, q2 = q2, q1
+    # 1D queries are 2D queries where the second range is identical to the first one
+    is_1d = rng.random(size) < _1d_to_2d_query_ratio
+    chrom2 = np.where(is_1d, chrom1, chrom2)
+    start2 = np.where(is_1d, start1, start2)
+    end2 = np.where(is_1d, end1, end2)
+
+    # Make sure queries overlap the upper-triangular matrix
+    swap = (ranks[chrom1] > ranks[chrom2]) | ((chrom1 == chrom2) & (start1 > start2))
+    chrom1, chrom2 = np.where(swap, chrom2, chrom1), np.where(swap, chrom1, chrom2)
+    start1, start2 = np.where(swap, start2, start1), np.where(swap, start1, start2)
+    end1, end2 = np.where(swap, end2, end1), np.where(swap, end1, end2)
+
+    return list(
+        zip(
+            chrom1.tolist(),
+            start1.tolist(),
+            end1.tolist(),
+            chrom2.tolist(),
+            start2.tolist(),
+            end2.tolist(),
+        )
+    )
 
-    if chrom1 == chrom2:
-        start1, _, _ = coord1.partition("-")
-        start2, _, _ = coord2.partition("-")
-        if int(start1) > int(start2):
-            q1, q2 = q2, q1
 
-    return q1, q2
+def format_query(chrom_names, chrom_id: int, start: int, end: int) -> str:
+    return f"{chrom_names[chrom_id]}:{start}-{end}"
 
 
 def find_differences(df1: pd.DataFrame, df2: pd.DataFrame) -> pd.DataFrame:
     df = df1.merge(
-        df2, how="outer", left_index=True, right_index=True, suffixes=("1", "2")
+        df2,
+        how="outer",
+        on=["bin1_id", "bin2_id"],
+        suffixes=("1", "2"),
+        indicator=True,
     )
-    # We're mapping False to None so that we can more easily drop identical rows with dropna()
-    df["count_close_enough"] = pd.Series(np.isclose(df["count1"], df["count2"])).map(
-        {False: None}
+    # Pixels with nan counts in both DataFrames are considered identical, while pixels
+    # missing from one of the DataFrames are always considered different
+    counts_differ = ~np.isclose(df["count1"], df["count2"], equal_nan=True)
+    return df[counts_differ | (df["_merge"] != "both")]
+
+
+def results_are_equal(df1: pd.DataFrame, df2: pd.DataFrame) -> bool:
+    # Fast path used to avoid aligning DataFrames when results are exactly the same
+    return (
+        np.array_equal(df1["bin1_id"], df2["bin1_id"])
+        and np.array_equal(df1["bin2_id"], df2["bin2_id"])
+        and np.array_equal(df1["count"], df2["count"], equal_nan=True)
     )
 
-    # We're dropping the counts to avoid incorrectly flagging rows with nan as counts
-    return df.drop(columns=["count1", "count2"]).dropna()
-
 
 def results_are_identical(worker_id, q1, q2, expected, found) -> bool:
     if len(expected) != len(found):
@@ -201,7 +342,7 @@ def results_are_identical(worker_id, q1, q2, expected, found) -> bool:
         )
         return False
 
-    if len(expected) != 0:
+    if len(expected) != 0 and not results_are_equal(expected, found):
         diff = find_differences(expected, found)
         if len(diff) != 0:
             logging.warning(
@@ -214,89 +355,138 @@ def results_are_identical(worker_id, q1, q2, expected, found) -> bool:
             )
             return False
 
-    logging.debug("[%d] %s, %s (%d nnz): OK!", worker_id, q1, q2, len(expected))
+    if debug_enabled:
+        logging.debug("[%d] %s, %s (%d nnz): OK!", worker_id, q1, q2, len(expected))
     return True
 
 
-def seed_prng(worker_id: int, seed):
-    seed = hash(tuple([worker_id, seed]))
+def seed_prng(worker_id: int, seed: int) -> np.random.Generator:
     logging.info("[%d] seed: %d", worker_id, seed)
-    random.seed(seed)
+    # Using the worker ID as spawn key gives each worker a reproducible stream of
+    # random numbers that is independent of the streams used by the other workers
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(worker_id,)))
 
 
-def worker(
+def init_worker(
     path_to_cooler: pathlib.Path,
     path_to_coolerpp_dump: pathlib.Path,
-    chroms_flat,
-    chrom_ranks,
+    chrom_names: List[str],
+    chrom_sizes: np.ndarray,
+    chrom_cum_weights: np.ndarray,
     query_length_mu: float,
     query_length_std: float,
     _1d_to_2d_query_ratio: float,
     balance: Union[str, None],
     seed: int,
-    worker_id: int,
-    end_time,
-) -> Tuple[int, int]:
+    early_return_: mp.Event,
+):
+    global worker_ctx
     global early_return
-
-    num_failures = 0
-    num_queries = 0
+    global debug_enabled
 
     if balance is None or balance == "raw":
         balance = False
 
-    try:
-        seed_prng(worker_id, seed)
+    # Chromosomes are ranked based on their position in the chromosome table
+    worker_ctx = {
+        "path_to_cooler": path_to_cooler,
+        "path_to_coolerpp_dump": path_to_coolerpp_dump,
+        "chrom_names": chrom_names,
+        "chrom_sizes": chrom_sizes,
+        "chrom_cum_weights": chrom_cum_weights,
+        "chrom_ranks": np.arange(len(chrom_names)),
+        "query_length_mu": query_length_mu,
+        "query_length_std": query_length_std,
+        "1d_to_2d_query_ratio": _1d_to_2d_query_ratio,
+        "balance": balance,
+        "seed": seed,
+    }
+    early_return = early_return_
+    debug_enabled = logging.getLogger().isEnabledFor(logging.DEBUG)
+
+
+def worker(worker_id: int, end_time) -> Tuple[int, int]:
+    num_failures = 0
+    num_queries = 0
 
-        chrom_sizes = np.array([n for _, n in chroms_flat], dtype=int)
-        weights = chrom_sizes / chrom_sizes.sum()
+    path_to_cooler = worker_ctx["path_to_cooler"]
+    balance = worker_ctx["balance"]
 
-        sel = cooler.Cooler(str(path_to_cooler)).matrix(
-            balance=balance, as_pixels=True, join=True
+    h5f = None
+    coolerpp_dump = None
+    try:
+        rng = seed_prng(worker_id, worker_ctx["seed"])
+        queries = collections.deque()
+        # Number of queries sent to coolerpp_dump at once
+        batch_size = 16
+
+        # Use a large chunk cache so that chunks revisited by subsequent queries
+        # do not have to be read and decompressed again
+        file_path, group_path = cooler.util.parse_cooler_uri(str(path_to_cooler))
+        h5f = h5py.File(file_path, "r", rdcc_nbytes=256 << 20, rdcc_nslots=1_000_003)
+        sel = cooler.Cooler(h5f[group_path]).matrix(
+            balance=balance, as_pixels=True, join=False
+        )
+        coolerpp_dump = CoolerppDumpProc(
+            worker_ctx["path_to_coolerpp_dump"], path_to_cooler, balance
         )
 
         while time.time() < end_time:
-            if early_return.value:
+            if early_return.is_set():
                 logging.debug(
                     "[%d] early return signal received. Returning immediately!",
                     worker_id,
                 )
                 break
 
-            if _1d_to_2d_query_ratio <= random.random():
-                q1, q2 = generate_query_2d(
-                    chroms_flat,
-                    weights,
-                    chrom_ranks,
-                    mean_length=query_length_mu,
-                    stddev_length=query_length_std,
+            if len(queries) < batch_size:
+                queries.extend(
+                    generate_query_batch(
+                        rng,
+                        worker_ctx["chrom_sizes"],
+                        worker_ctx["chrom_cum_weights"],
+                        worker_ctx["chrom_ranks"],
+                        mean_length=worker_ctx["query_length_mu"],
+                        stddev_length=worker_ctx["query_length_std"],
+                        _1d_to_2d_query_ratio=worker_ctx["1d_to_2d_query_ratio"],
+                    )
                 )
-            else:
-                q1 = generate_query_1d(
-                    chroms_flat,
-                    weights,
-                    mean_length=query_length_mu,
-                    stddev_length=query_length_std,
+            chrom_names = worker_ctx["chrom_names"]
+            batch = []
+            for _ in range(batch_size):
+                chrom1, start1, end1, chrom2, start2, end2 = queries.popleft()
+                batch.append(
+                    (
+                        format_query(chrom_names, chrom1, start1, end1),
+                        format_query(chrom_names, chrom2, start2, end2),
+                    )
                 )
-                q2 = q1
 
-            num_queries += 1
-            expected = cooler_dump(sel, q1, q2)
-            found = coolerpp_dump(
-                path_to_coolerpp_dump, path_to_cooler, balance, q1, q2
-            )
+            # coolerpp_dump processes the queries while we are fetching the expected
+            # results with cooler
+            coolerpp_dump.submit(batch)
+            expected = [cooler_dump(sel, q1, q2) for q1, q2 in batch]
 
-            if not results_are_identical(worker_id, q1, q2, expected, found):
-                num_failures += 1
+            for (q1, q2), df in zip(batch, expected):
+                num_queries += 1
+                found = coolerpp_dump.read_result()
+                if not results_are_identical(worker_id, q1, q2, df, found):
+                    num_failures += 1
 
     except:
         logging.debug(
             "[%d] exception raised in worker process. Sending early return signal!",
             worker_id,
         )
-        early_return.value = True
+        early_return.set()
         raise
 
+    finally:
+        if coolerpp_dump is not None:
+            coolerpp_dump.close()
+        if h5f is not None:
+            h5f.close()
+
     return num_queries, num_failures
 
 
@@ -304,29 +494,42 @@ def main():
     args = vars(make_cli().parse_args())
 
     chroms = read_chrom_sizes(args["cooler"])
-    chrom_ranks = {chrom: i for i, chrom in enumerate(chroms.keys())}
-    chroms_flat = list(chroms.items())
+    chrom_sizes = np.array(list(chroms.values()), dtype=int)
+    # Chromosomes are sampled proportionally to their size
+    chrom_cum_weights = np.cumsum(chrom_sizes)
 
+    early_return = mp.Event()
     end_time = time.time() + args["duration"]
 
-    with mp.Pool(args["nproc"]) as pool:
-        results = pool.starmap(
-            worker,
-            zip(
-                itertools.repeat(args["cooler"]),
-                itertools.repeat(args["path_to_coolerpp_dump"]),
-                itertools.repeat(chroms_flat),
-                itertools.repeat(chrom_ranks),
-                itertools.repeat(args["query_length_avg"]),
-                itertools.repeat(args["query_length_std"]),
-                itertools.repeat(args["1d_to_2d_query_ratio"]),
-                itertools.repeat(args["balance"]),
-                itertools.repeat(args["seed"]),
-                range(args["nproc"]),
-                itertools.repeat(end_time),
-            ),
-            chunksize=1,
-        )
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=args["nproc"],
+        initializer=init_worker,
+        initargs=(
+            args["cooler"],
+            args["path_to_coolerpp_dump"],
+            list(chroms.keys()),
+            chrom_sizes,
+            chrom_cum_weights,
+            args["query_length_avg"],
+            args["query_length_std"],
+            args["1d_to_2d_query_ratio"],
+            args["balance"],
+            args["seed"],
+            early_return,
+        ),
+    ) as pool:
+        futures = [
+            pool.submit(worker, worker_id, end_time)
+            for worker_id in range(args["nproc"])
+        ]
+
+        results = []
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results.append(future.result())
+            except:
+                early_return.set()
+                raise
 
     num_queries = sum((n for n, _ in results))
     num_failures = sum((n for _, n in results))
@@ -355,5 +558,4 @@ def setup_logger(level=logging.INFO):
 
 if __name__ == "__main__":
     setup_logger()
-    early_return = mp.Value(ctypes.c_bool, False)
     sys.exit(main())